@@ -1 +1,2 @@
-__all__ = ['gnome_apps_helper', 'kde_apps_helper']
+__all__ = ['gnome_apps_helper', 'kde_apps_helper', 'step_policy', 'dialog_watcher', 'input_sequence',
+           'screencast', 'tree_search', 'crash_triage']
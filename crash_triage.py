@@ -0,0 +1,234 @@
+#!/usr/bin/python
+"""
+Triage of the core dumps caught in /tmp/cores.
+
+Every core dump found by the helpers is handed to a worker process which
+extracts the backtrace with gdb (or eu-stack), computes a signature from
+the top frames and keeps one compressed core per signature. The worker is
+this module run as a niced script, so nothing of the test is re-imported
+or forked; the summary is attached to the test result at its end.
+"""
+import os
+import re
+import sys
+import time
+import gzip
+import shutil
+import hashlib
+from subprocess import Popen, PIPE
+
+try:
+    from .step_policy import STATS_DIR, loadJson, saveJson, updateJson, makeDirs
+except (ImportError, ValueError):
+    from step_policy import STATS_DIR, loadJson, saveJson, updateJson, makeDirs
+
+TRIAGE_DIR = os.path.join(STATS_DIR, 'crashes')
+
+# cores are linked here (on the same filesystem as /tmp/cores) so that
+# updateCorePattern of the next test can't remove them under the worker
+PENDING_DIR = '/tmp/cores-triage'
+
+# seconds the symbolization and the wait for the dump to be finished may take
+SYMBOLIZE_TIMEOUT = 120
+DUMP_TIMEOUT = 60
+
+FRAME_REGEXP = re.compile(r'^#\d+\s+(?:0x[0-9a-f]+\s+(?:in\s+)?)?([^\s(]+)')
+
+
+def getBacktrace(corePath, executable):
+    """
+    Return the backtrace of the crashed thread, empty string if there are no tools
+    """
+    limit = ['timeout', '-s', 'KILL', str(SYMBOLIZE_TIMEOUT)]
+    commands = [
+        limit + ['gdb', '-batch', '-nx', '-ex', 'bt', executable, corePath],
+        limit + ['eu-stack', '--core=%s' % corePath, '--executable=%s' % executable],
+    ]
+    for command in commands:
+        try:
+            proc = Popen(command, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        except OSError:
+            continue
+        output = proc.communicate()[0]
+        if '#0' in output:
+            return output
+    return ''
+
+
+def getSignature(backtrace, depth=5):
+    """
+    Hash of the names of the top frames of the backtrace
+    """
+    frames = []
+    for line in backtrace.splitlines():
+        # eu-stack prints all the threads, only the first one is used
+        if line.startswith('TID ') and frames:
+            break
+        match = FRAME_REGEXP.match(line.strip())
+        if match and match.group(1) != '??':
+            frames.append(match.group(1))
+    frames = frames[:depth]
+    if not frames:
+        return None, frames
+    return hashlib.sha1('|'.join(frames).encode('utf-8')).hexdigest()[:12], frames
+
+
+def findExecutable(command):
+    proc = Popen("which %s" % command, shell=True, stdout=PIPE, universal_newlines=True)
+    output = proc.communicate()[0].strip()
+    return output or command
+
+
+def isDumping(pid):
+    """
+    The kernel writes the core before the crashed process becomes a zombie
+    """
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return False
+    # the state follows the executable name in parentheses, which may contain anything
+    return stat.rsplit(')', 1)[-1].split()[0] != 'Z'
+
+
+def waitForDump(pid):
+    """
+    Wait until the core is written, returns False if it doesn't happen in time
+    """
+    deadline = time.time() + DUMP_TIMEOUT
+    while isDumping(pid):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.5)
+    return True
+
+
+def registerSignature(triageDir, signature, frames, name):
+    """
+    Count the core in the index, returns how many times the signature was seen
+    """
+    def update(index):
+        entry = index.setdefault(signature, {'count': 0, 'frames': frames, 'cores': []})
+        entry['count'] += 1
+        entry['cores'].append(name)
+
+    index = updateJson(os.path.join(triageDir, 'index.json'), update)
+    if index is None:
+        return None
+    return index[signature]['count']
+
+
+def triageCore(corePath, command, triageDir):
+    """
+    Worker: symbolize the core, dedupe it by the signature and write the summary
+    """
+    try:
+        runTriage(corePath, command, triageDir)
+    finally:
+        # the link in PENDING_DIR is not needed anymore
+        try:
+            os.remove(corePath)
+        except OSError:
+            pass
+
+
+def runTriage(corePath, command, triageDir):
+    name = os.path.basename(corePath)
+    # core.%e.%s.%p, the executable name may contain dots itself
+    (signal, pid) = name.split('.')[-2:]
+    if not makeDirs(triageDir):
+        print("Warning: %s is not triaged" % name)
+        return
+    if not waitForDump(pid):
+        print("Warning: process %s is still around, %s may be incomplete" % (pid, name))
+    backtrace = getBacktrace(corePath, findExecutable(command))
+    (signature, frames) = getSignature(backtrace)
+    summary = {
+        'core': name,
+        'command': command,
+        'signal': int(signal),
+        'signature': signature,
+        'frames': frames,
+        'backtrace': backtrace,
+    }
+    seen = None
+    if signature is not None:
+        seen = registerSignature(triageDir, signature, frames, name)
+    if seen is not None:
+        summary['seen'] = seen
+    if seen in (1, None):
+        # keep the first core of every signature, compressed
+        summary['kept'] = os.path.join(triageDir, name + '.gz')
+        src = open(corePath, 'rb')
+        dst = gzip.open(summary['kept'], 'wb')
+        try:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        finally:
+            src.close()
+            dst.close()
+    saveJson(os.path.join(triageDir, name + '.json'), summary)
+
+
+class CrashTriage(object):
+
+    """
+    Starts a worker for every new core dump and collects the summaries
+    """
+
+    def __init__(self, triageDir=None):
+        if triageDir is None:
+            triageDir = TRIAGE_DIR
+        self.triageDir = triageDir
+        self.workers = {}
+
+    def submit(self, corePath, command):
+        """
+        Triage the core dump in the background, each one only once
+        """
+        name = os.path.basename(corePath)
+        if name in self.workers:
+            return
+        # the worker creates the directory, the triage must never fail the test
+        try:
+            if not makeDirs(PENDING_DIR):
+                return
+            pendingPath = os.path.join(PENDING_DIR, name)
+            if not os.path.exists(pendingPath):
+                os.link(corePath, pendingPath)
+            worker = Popen(
+                ['nice', '-n', '10', sys.executable, os.path.abspath(__file__), pendingPath, command,
+                 self.triageDir], close_fds=True)
+        except OSError as error:
+            print("Warning: could not start the triage of %s: %s" % (name, error))
+            return
+        self.workers[name] = worker
+        print("*** Triaging the core dump %s in the background" % name)
+
+    def report(self, timeout=60):
+        """
+        Wait for the workers (at most timeout seconds in total) and print the summaries
+        """
+        summaries = []
+        deadline = time.time() + timeout
+        for name in sorted(self.workers):
+            while self.workers[name].poll() is None and time.time() < deadline:
+                time.sleep(0.5)
+            summaryPath = os.path.join(self.triageDir, name + '.json')
+            if self.workers[name].poll() is None:
+                print("*** The triage of %s is still running, see %s" % (name, summaryPath))
+                continue
+            summary = loadJson(summaryPath)
+            if not summary:
+                print("!!! The triage of %s failed" % name)
+                continue
+            print("*** Core dump %s, signal %d, signature %s (seen %d times)" % (
+                name, summary['signal'], summary['signature'], summary.get('seen', 1)))
+            if summary['backtrace']:
+                print(summary['backtrace'])
+            summaries.append(summary)
+        return summaries
+
+
+if __name__ == '__main__':
+    triageCore(*sys.argv[1:4])
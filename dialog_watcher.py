@@ -0,0 +1,144 @@
+#!/usr/bin/python
+"""
+Watcher of dialogs blocking the app start (polkit authentication, keyring
+unlock, first-run dialogs, ...).
+
+The watcher is polled by the helpers while they wait for the app, so every
+dialog is handled the moment it shows up instead of after a blind sleep.
+The polling happens in the test's own thread as the AT-SPI client library
+is not thread safe.
+"""
+import time
+
+from dogtail.tree import root, SearchError
+from dogtail import predicate
+from dogtail.rawinput import keyCombo, typeText
+
+try:
+    from .tree_search import findFirst
+except (ImportError, ValueError):
+    from tree_search import findFirst
+
+# roles whose subtrees can't hold a dialog, skipped while looking for one
+PRUNE_ROLES = (
+    'label', 'push button', 'toggle button', 'menu', 'menu bar', 'menu item', 'list', 'list item',
+    'table', 'tree table', 'tool bar', 'text', 'password text', 'icon', 'image')
+
+
+class DialogRule(object):
+
+    """
+    A known dialog and the way to get rid of it
+    """
+
+    def __init__(
+        self, name, appName, dialogName, roleName='label', text=None, keys='<Enter>', action=None,
+            pruneRoles=PRUNE_ROLES):
+        """
+        name        name of the rule used in the messages
+        appName     a11y name of the app owning the dialog
+        dialogName  name of the node that identifies the dialog
+        roleName    role of that node
+        text        text to type into the dialog, if any
+        keys        key combo confirming the dialog, if any
+        action      callable taking the found node, replaces text and keys
+        pruneRoles  roles whose subtrees are not searched for the dialog
+        """
+        self.name = name
+        self.appName = appName
+        self.dialogName = dialogName
+        self.roleName = roleName
+        self.text = text
+        self.keys = keys
+        self.action = action
+        self.pruneRoles = pruneRoles
+
+    def find(self):
+        """
+        Return the showing node identifying the dialog or None, only the
+        showing parts of the app are searched as this runs on every poll
+        """
+        try:
+            app = root.child(name=self.appName, roleName='application', retry=False, recursive=False)
+            return findFirst(
+                app, predicate.GenericPredicate(name=self.dialogName, roleName=self.roleName),
+                pruneRoles=self.pruneRoles, showingOnly=True)
+        except SearchError:
+            return None
+        except Exception:
+            # nodes can vanish under the walk while the shell animates
+            return None
+
+    def handle(self, node):
+        if self.action is not None:
+            self.action(node)
+            return
+        if self.text is not None:
+            typeText(self.text)
+        if self.keys is not None:
+            keyCombo(self.keys)
+
+
+def polkitRule(password):
+    """The GNOME Shell polkit authentication agent"""
+    return DialogRule('polkit', 'gnome-shell', 'Authentication Required', text=password)
+
+
+def kdePolkitRule(password):
+    """The KDE polkit authentication agent"""
+    return DialogRule(
+        'polkit', 'polkit-kde-authentication-agent-1', 'Authentication Required', roleName='dialog',
+        text=password)
+
+
+def keyringRule(password):
+    """The GNOME Shell keyring unlock prompt"""
+    return DialogRule('keyring', 'gnome-shell', 'Unlock Login Keyring', text=password)
+
+
+class DialogWatcher(object):
+
+    """
+    Handles each known dialog once per arm() and remembers when it did so
+    """
+
+    def __init__(self, rules=None):
+        if rules is None:
+            rules = []
+        self.rules = list(rules)
+        self.armed = None
+        self.handled = []
+
+    def addRule(self, rule):
+        self.rules.append(rule)
+
+    def arm(self):
+        """
+        Start watching, called right before the action which may pop a dialog up
+        """
+        self.armed = time.time()
+        self.handled = []
+
+    def poll(self):
+        """
+        Handle the dialogs which are showing, returns the number of handled ones
+        """
+        if self.armed is None:
+            return 0
+        count = 0
+        done = [name for (name, delay) in self.handled]
+        for rule in self.rules:
+            if rule.name in done:
+                continue
+            node = rule.find()
+            if node is None:
+                continue
+            delay = time.time() - self.armed
+            print("*** Handling the %s dialog, it appeared after %.1fs" % (rule.name, delay))
+            rule.handle(node)
+            self.handled.append((rule.name, delay))
+            count += 1
+        return count
+
+    def disarm(self):
+        self.armed = None
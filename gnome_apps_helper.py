@@ -8,6 +8,7 @@ import sys
 import time
 import os
 import re
+import shlex
 
 from dogtail.utils import isA11yEnabled, enableA11y, GnomeShell
 if isA11yEnabled() is False:
@@ -17,20 +18,50 @@ if isA11yEnabled() is False:
         time.sleep(5)
         print("Warning: second attempt to enable a11y")
 
-from dogtail.utils import run as utilsRun
 from dogtail.tree import root
 from dogtail.tree import SearchError
 from dogtail import predicate
-from dogtail.rawinput import keyCombo, click, typeText, absoluteMotion, pressKey
+from dogtail.rawinput import keyCombo, click, doubleClick
 from subprocess import Popen, PIPE
 from iniparse import ConfigParser
 import traceback
 
+try:
+    from .step_policy import (
+        StepPolicy, policyStep, ATSPI_TIMEOUT, PROCESS_CRASH, CORE_DUMP, SEARCH_MISS, NOT_RUNNING)
+except (ImportError, ValueError):
+    from step_policy import (
+        StepPolicy, policyStep, ATSPI_TIMEOUT, PROCESS_CRASH, CORE_DUMP, SEARCH_MISS, NOT_RUNNING)
+try:
+    from .dialog_watcher import DialogWatcher, polkitRule, keyringRule
+except (ImportError, ValueError):
+    from dialog_watcher import DialogWatcher, polkitRule, keyringRule
+try:
+    from .input_sequence import InputSequence
+except (ImportError, ValueError):
+    from input_sequence import InputSequence
+try:
+    from .screencast import ScreencastRecorder
+except (ImportError, ValueError):
+    from screencast import ScreencastRecorder
+try:
+    from .tree_search import iterChildren
+except (ImportError, ValueError):
+    from tree_search import iterChildren
+try:
+    from .crash_triage import CrashTriage
+except (ImportError, ValueError):
+    from crash_triage import CrashTriage
+
 # we must kill this vermin before we start at all
 Popen("pkill gnome-initital", shell=True).wait()
 
-def getMiniaturesPosition(name):
-    """Get a position of miniature on Overview"""
+def getMiniaturesPosition(name, limit=None, showingOnly=False):
+    """
+    Get a position of miniature on Overview
+    limit       stop the search after the first 'limit' miniatures
+    showingOnly skip the labels which are not showing (and whatever is under them)
+    """
     miniatures = []
 
     over = root.application('gnome-shell').child(name='Overview')
@@ -38,10 +69,14 @@ def getMiniaturesPosition(name):
     if mini == over:
         print("Overview is not active")
         return miniatures
-    widgets = mini.findChildren(
-        predicate.GenericPredicate(name=name, roleName='label'))
+    # labels have no interesting children
+    widgets = iterChildren(
+        mini, predicate.GenericPredicate(name=name, roleName='label'),
+        pruneRoles=('label',), showingOnly=showingOnly)
 
     for widget in widgets:
+        if limit is not None and len(miniatures) >= limit:
+            break
         (x, y) = widget.position
         (a, b) = widget.size
         miniatures.append((x + a / 2, y + b / 2 - 100))
@@ -56,6 +91,19 @@ def getDashIconPosition(name):
     (a, b) = button.size
     return (x + a / 2, y + b / 2)
 
+def closeOverview(attempts=3):
+    """Press Escape until the Overview (and the app grid in it) is gone"""
+    for i in range(attempts):
+        try:
+            over = root.application('gnome-shell').child(name='Overview', retry=False)
+        except SearchError:
+            return True
+        if over.parent.children[-1] == over:
+            return True
+        InputSequence().pressKey('Escape').wait(1).send()
+    return False
+
+
 def clickFocus(frame, maximize=False):
     """ Will focus on the window by clicking in the middle of its frame's titlebar.
     Input a frame or dialog, will try to get its coords and click the titlebar"""
@@ -86,18 +134,28 @@ class App(object):
     Does all basic events with app
     """
 
+    pollInterval = 0.5  # how often to check for the app while waiting for it
+    inputDelay = 0.1  # delay between the events of one InputSequence
+
     def __init__(
         self, appName, critical=None, shortcut='<Control><Q>', desktopFileName=None, a11yAppName=None, quitButton=None, timeout=5,
-            forceKill=True, parameters='', polkit=False, recordVideo=True):
+            forceKill=True, parameters='', polkit=False, recordVideo=True, policy=None,
+            dialogWatcher=None, recordPreset='low'):
         """
         Initialize object App
         appName     command to run the app
         critical    what's the function we check? {start,quit}
         shortcut    default quit shortcut
-        timeout     timeout for starting and shuting down the app
+        timeout     timeout for starting and shuting down the app, until its usual
+                    start/quit latencies are known
         forceKill   is the app supposed to be kill before/after test?
         parameters  has the app any params needed to start? (only for startViaCommand)
         desktopFileName = name of the desktop file if other than appName (without .desktop extension)
+        policy      StepPolicy retrying the start/quit steps, default one if None, False to disable
+        dialogWatcher   DialogWatcher handling dialogs popping up on start, by default
+                        the polkit (if polkit) and keyring ones
+        recordVideo     record a screencast of the test, kept only if the test fails
+        recordPreset    framerate/resolution preset of the screencast, see screencast.PRESETS
         """
         self.appCommand = appName
         self.shortcut = shortcut
@@ -107,6 +165,8 @@ class App(object):
         self.quitButton = quitButton
         # the result remains false until the correct result is verified
         self.result = False
+        self.triage = CrashTriage()
+        self.crashes = []
         self.updateCorePattern()
         self.parameters = parameters
         self.internCommand = self.appCommand.lower()
@@ -114,17 +174,27 @@ class App(object):
         self.polkitPass = 'redhat'
         self.a11yAppName = a11yAppName
         self.recordVideo = recordVideo
+        self.recorder = None
+        if policy is None:
+            policy = StepPolicy()
+        self.policy = policy or None
+        self.lastFailure = None
+        if dialogWatcher is None:
+            dialogWatcher = DialogWatcher([keyringRule(self.polkitPass)])
+            if self.polkit:
+                dialogWatcher.addRule(polkitRule(self.polkitPass))
+        self.dialogWatcher = dialogWatcher
 
         if desktopFileName is None:
             desktopFileName = self.appCommand
         self.desktopFileName = desktopFileName
 
         # a way of overcoming overview autospawn when mouse in 1,1 from start
-        pressKey('Esc')
-        absoluteMotion(100, 100, 2)
+        InputSequence(self.inputDelay).pressKey('Esc').absoluteMotion(100, 100).send()
         # attempt to make a recording of the test
         if self.recordVideo:
-            keyCombo('<Control><Alt><Shift>R')
+            self.recorder = ScreencastRecorder(self.appCommand, recordPreset)
+            self.recorder.start()
 
     def parseDesktopFile(self):
         """
@@ -144,12 +214,13 @@ class App(object):
         """
         Ends the test with correct return value
         """
-        if self.recordVideo:
-            keyCombo('<Control><Alt><Shift>R')
         time.sleep(2)
         if not isProcessRunning('gnome-shell') or isProcessRunning('gnome-shell --mode=gdm'):
             print ("Error: gnome-shell/Xorg crashed during or after the test!")
             self.result = False
+        if self.recorder is not None:
+            self.recorder.finish(self.result)
+        self.crashes = self.triage.report()
 
         if self.result:
             print("PASS")
@@ -199,7 +270,7 @@ class App(object):
             if i in groupConversionDict:
                 return groupConversionDict[i]
 
-    def isRunning(self):
+    def isRunning(self, quiet=False):
         """
         Is the app running?
         """
@@ -225,25 +296,113 @@ class App(object):
                     return i
             return None
 
-        print("*** Checking if '%s' is running" % self.a11yAppName)
+        if not quiet:
+            print("*** Checking if '%s' is running" % self.a11yAppName)
         try:  # should the a11y app reload due to start screen (i.e. gimp)
             app = getApp()
         except:
             time.sleep(5)
             app = getApp()
         if app is None or len(app) == 0:
-            print("*** The app '%s' is not running" % self.a11yAppName)
+            if not quiet:
+                print("*** The app '%s' is not running" % self.a11yAppName)
             return False
         else:
-            print("*** The app '%s' is running" % self.a11yAppName)
+            if not quiet:
+                print("*** The app '%s' is running" % self.a11yAppName)
             return True
 
+    def appId(self):
+        return self.appCommand
+
+    def readinessWindow(self, step, method):
+        """
+        How long to wait for the app to start or quit
+        """
+        if self.policy is None:
+            return self.timeout
+        return self.policy.window(self.appId(), step, method, self.timeout)
+
+    def waitForApp(self, step, method, running=True):
+        """
+        Wait until the app is running (or is gone) and remember how long it took,
+        give up after the readiness window. Nothing is remembered if the app was
+        already in the awaited state, e.g. it was left running.
+        """
+        window = self.readinessWindow(step, method)
+        start = time.time()
+        waited = False
+        while self.isRunning(quiet=True) != running:
+            waited = True
+            if time.time() - start > window:
+                return False
+            if self.dialogWatcher.poll() == 0:
+                time.sleep(self.pollInterval)
+        if waited and self.policy is not None:
+            self.policy.recordLatency(self.appId(), method, time.time() - start)
+        return True
+
+    def checkDialogs(self, method):
+        """
+        Stop watching for dialogs. With polkit, keep watching until its dialog
+        is handled, the app may ask for it only after its window is up; returns
+        False if it did not appear within the readiness window from the launch
+        """
+        deadline = self.dialogWatcher.armed + self.readinessWindow('start', method)
+        try:
+            while self.polkit and 'polkit' not in [name for (name, delay) in self.dialogWatcher.handled]:
+                if time.time() > deadline:
+                    print("!!! The polkit dialog did not appear")
+                    return False
+                if self.dialogWatcher.poll() == 0:
+                    time.sleep(self.pollInterval)
+            return True
+        finally:
+            self.dialogWatcher.disarm()
+
+    def beginAttempt(self, step):
+        self.lastFailure = None
+        if self.recorder is not None:
+            self.recorder.segment(step)
+
+    def classifyFailure(self, step):
+        """
+        Tell what kind of failure the last attempt of the step ended with
+        """
+        # the video of a failed attempt is worth keeping
+        if self.recorder is not None:
+            self.recorder.keep()
+        if self.existsCoreDump() != 0:
+            return CORE_DUMP
+        if self.lastFailure is not None:
+            return self.lastFailure
+        if step == 'start' and not isProcessRunning(self.appCommand):
+            return PROCESS_CRASH
+        return ATSPI_TIMEOUT
+
+    def prepareRetry(self, step):
+        """
+        Get the app into a state the step can be repeated from
+        """
+        if step == 'start':
+            # a failed search leaves the Overview or the app grid open
+            if not closeOverview():
+                print("!!! The Overview could not be closed")
+                return False
+            if self.isRunning():
+                self.kill()
+                time.sleep(2)
+            return True
+        # the app could have been killed already
+        return self.isRunning()
+
+    def endStep(self, step):
+        pass
+
     def kill(self):
         """
         Kill the app via 'killall'
         """
-        if self.recordVideo:
-            keyCombo('<Control><Alt><Shift>R')
         print("*** Killing all '%s' instances" % self.appCommand)
         return Popen("pkill " + self.appCommand, shell=True).wait()
 
@@ -268,9 +427,11 @@ class App(object):
         regexp = "core\.%s\.[0-9]{1,3}\.[0-9]*" % self.appCommand
         for f in files:
             if re.match(regexp, f):
+                self.triage.submit(dirPath + f, self.appCommand)
                 return int(f.split(".")[2])
         return 0
 
+    @policyStep('start')
     def startViaMenu(self, throughCategories=False):
         """
         Start the app via Gnome Shell menu
@@ -292,18 +453,17 @@ class App(object):
                 print("*** The app has been killed succesfully")
 
         try:
+            self.dialogWatcher.arm()
             # panel button Activities
             gnomeShell = root.application('gnome-shell')
-            pressKey('Super_L')
-            time.sleep(6)  # time for overview to appear
+            # time for overview to appear
+            InputSequence(self.inputDelay).pressKey('Super_L').wait(6).send()
 
             if throughCategories:
                 # menu Applications
                 x, y = getDashIconPosition('Show Applications')
-                absoluteMotion(x, y)
-                time.sleep(1)
-                click(x, y)
-                time.sleep(4)  # time for all the oversized app icons to appear
+                # time for all the oversized app icons to appear
+                InputSequence(self.inputDelay).absoluteMotion(x, y).wait(1).click(x, y).wait(4).send()
 
                 # submenu that contains the app
                 submenu = gnomeShell.child(
@@ -316,19 +476,11 @@ class App(object):
                     name=self.getName(), roleName='label')
                 app.click()
             else:
-                typeText(self.getName())
-                time.sleep(2)
-                pressKey('Enter')
-
-            # if there is a polkit
-            if self.polkit:
-                time.sleep(3)
-                typeText(self.polkitPass)
-                keyCombo('<Enter>')
+                InputSequence(self.inputDelay).typeText(self.getName()).wait(2).pressKey('Enter').send()
 
-            time.sleep(self.timeout)
+            self.waitForApp('start', 'startViaMenu')
 
-            if self.isRunning():
+            if self.checkDialogs('startViaMenu') and self.isRunning():
                 print("*** The app started successfully")
                 if internCritical:
                     self.updateResult(True)
@@ -339,11 +491,15 @@ class App(object):
                     self.updateResult(False)
                 return False
         except SearchError:
+            self.lastFailure = SEARCH_MISS
             print("!!! Lookup error while passing the path")
             if internCritical:
                 self.updateResult(False)
             return False
+        finally:
+            self.dialogWatcher.disarm()
 
+    @policyStep('start')
     def startViaCommand(self):
         """
         Start the app via command
@@ -361,16 +517,20 @@ class App(object):
                 print("*** The app has been killed succesfully")
 
         returnValue = 0
+        dialogsHandled = False
         command = "%s %s" % (self.appCommand, self.parameters)
-        returnValue = utilsRun(command, timeout=10, dumb=True)
-
-        # if there is a polkit
-        if self.polkit:
-            time.sleep(3)
-            typeText(self.polkitPass)
-            keyCombo('<Enter>')
-
-        time.sleep(self.timeout)
+        self.dialogWatcher.arm()
+        try:
+            # launched without any waiting, waitForApp polls from the launch on
+            try:
+                returnValue = Popen(shlex.split(command)).pid
+            except OSError:
+                returnValue = None
+            if returnValue is not None:
+                self.waitForApp('start', 'startViaCommand')
+                dialogsHandled = self.checkDialogs('startViaCommand')
+        finally:
+            self.dialogWatcher.disarm()
 
         # check the returned values
         if returnValue is None:
@@ -379,7 +539,7 @@ class App(object):
             print("!!! The app command could not be found")
             return False
         else:
-            if self.isRunning():
+            if dialogsHandled and self.isRunning():
                 if internCritical:
                     self.updateResult(True)
                 print("*** The app started successfully")
@@ -390,6 +550,7 @@ class App(object):
                 print("!!! The app did not started despite the fact that the command was found")
                 return False
 
+    @policyStep('quit')
     def closeViaShortcut(self):
         """
         Close the app via shortcut
@@ -397,13 +558,14 @@ class App(object):
         internCritical = (self.critical == 'quit')
 
         if not self.isRunning():
+            self.lastFailure = NOT_RUNNING
             if internCritical:
                 self.updateResult(False)
             print("!!! The app does not seem to be running")
             return False
 
         keyCombo(self.shortcut)
-        time.sleep(self.timeout)
+        self.waitForApp('quit', 'closeViaShortcut', running=False)
 
         if self.isRunning():
             if self.forceKill:
@@ -423,6 +585,7 @@ class App(object):
             print("*** The app was successfully closed")
             return True
 
+    @policyStep('quit')
     def closeViaMenu(self):
         """
         Close app via menu button
@@ -430,6 +593,7 @@ class App(object):
         internCritical = (self.critical == 'quit')
 
         if not self.isRunning():
+            self.lastFailure = NOT_RUNNING
             if internCritical:
                 self.updateResult(False)
             print("!!! The app does not seem to be running")
@@ -446,6 +610,7 @@ class App(object):
                     length = length - 1
                     closeButton = firstSubmenu.children[length]
                     if length < 0:
+                        self.lastFailure = SEARCH_MISS
                         if internCritical:
                             self.updateResult(False)
                         print("!!! The app quit button coldn't be found")
@@ -453,6 +618,7 @@ class App(object):
             else:
                 closeButton = firstSubmenu.child(self.quitButton)
         except SearchError:
+            self.lastFailure = SEARCH_MISS
             if internCritical:
                 self.updateResult(False)
             print("!!! The app menu bar or the quit button could'n be found")
@@ -463,7 +629,7 @@ class App(object):
         time.sleep(2)  # timeout until menu appear
         print("*** Trying to click to '%s'" % closeButton)
         closeButton.click()
-        time.sleep(self.timeout)
+        self.waitForApp('quit', 'closeViaMenu', running=False)
 
         if self.isRunning():
             if self.forceKill:
@@ -525,6 +691,7 @@ class App(object):
         except:
             return None
 
+    @policyStep('quit')
     def closeViaGnomePanel(self):
         """
         Close the app via menu at gnome-panel
@@ -534,6 +701,7 @@ class App(object):
         self.parseDesktopFile()
 
         if not self.isRunning():
+            self.lastFailure = NOT_RUNNING
             if internCritical:
                 self.updateResult(False)
             print("!!! The app does not seem to be running")
@@ -543,7 +711,7 @@ class App(object):
         shell = GnomeShell()
         shell.clickApplicationMenuItem(self.getName(), 'Quit')
 
-        time.sleep(self.timeout)
+        self.waitForApp('quit', 'closeViaGnomePanel', running=False)
 
         if self.isRunning():
             if self.forceKill:
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+"""
+Batched input for the app helpers.
+
+Every dogtail.rawinput call waits its own built-in delay (defaultDelay,
+actionDelay, typingDelay) after the event is sent. InputSequence collects
+the events of one interaction and sends them in one go with a single
+configurable delay between them, waits the interaction really needs are
+added explicitly with wait().
+"""
+import time
+
+from dogtail.config import config
+from dogtail import rawinput
+
+
+class InputSequence(object):
+
+    """
+    Builder of a sequence of input events, e.g.
+    InputSequence().pressKey('Esc').absoluteMotion(100, 100).send()
+    """
+
+    def __init__(self, delay=0.1):
+        """
+        delay   seconds between two consecutive events
+        """
+        self.delay = delay
+        self.actions = []
+
+    def add(self, function, *args, **kwargs):
+        self.actions.append((function, args, kwargs))
+        return self
+
+    def pressKey(self, keyName):
+        return self.add(rawinput.pressKey, keyName)
+
+    def keyCombo(self, comboString):
+        return self.add(rawinput.keyCombo, comboString)
+
+    def typeText(self, string):
+        return self.add(rawinput.typeText, string)
+
+    def click(self, x, y, button=1):
+        return self.add(rawinput.click, x, y, button)
+
+    def doubleClick(self, x, y, button=1):
+        return self.add(rawinput.doubleClick, x, y, button)
+
+    def absoluteMotion(self, x, y):
+        return self.add(rawinput.absoluteMotion, x, y, self.delay)
+
+    def wait(self, seconds):
+        """
+        An explicit pause, e.g. for the overview to appear
+        """
+        return self.add(time.sleep, seconds)
+
+    def send(self):
+        """
+        Send all the collected events and empty the sequence
+        """
+        saved = (config.defaultDelay, config.actionDelay, config.typingDelay)
+        config.defaultDelay = config.actionDelay = config.typingDelay = self.delay
+        try:
+            for (function, args, kwargs) in self.actions:
+                function(*args, **kwargs)
+        finally:
+            (config.defaultDelay, config.actionDelay, config.typingDelay) = saved
+        self.actions = []
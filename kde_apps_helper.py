@@ -6,7 +6,7 @@
  inherit from the KdeApp class to make a helper for specific KDE app.
 """
 
-import sys, time, os, re, pwd, traceback
+import sys, time, os, re, pwd, traceback, shlex
 
 from dogtail.utils import isA11yEnabled, enableA11y, screenshot
 if isA11yEnabled() is False:
@@ -16,13 +16,31 @@ if isA11yEnabled() is False:
         time.sleep(5)
         print("Warning: second attempt to enable a11y")
 
-from dogtail.utils import run as appRun
 from time import sleep
 from dogtail.tree import root, SearchError
-from dogtail.rawinput import keyCombo,click,doubleClick,typeText,pressKey
+from dogtail.rawinput import keyCombo,click,doubleClick
 from subprocess import Popen,PIPE
 from gi.repository import Gdk
 
+try:
+    from .step_policy import (
+        StepPolicy, policyStep, ATSPI_TIMEOUT, PROCESS_CRASH, CORE_DUMP, SEARCH_MISS, NOT_RUNNING)
+except (ImportError, ValueError):
+    from step_policy import (
+        StepPolicy, policyStep, ATSPI_TIMEOUT, PROCESS_CRASH, CORE_DUMP, SEARCH_MISS, NOT_RUNNING)
+try:
+    from .dialog_watcher import DialogWatcher
+except (ImportError, ValueError):
+    from dialog_watcher import DialogWatcher
+try:
+    from .input_sequence import InputSequence
+except (ImportError, ValueError):
+    from input_sequence import InputSequence
+try:
+    from .crash_triage import CrashTriage
+except (ImportError, ValueError):
+    from crash_triage import CrashTriage
+
 stdout_prefix = '>>> >>> '
 stderr_prefix = '!!! >>> '
 
@@ -48,8 +66,10 @@ class KdeApp(object):
 
     corner_distance = 10
     splashscreen_delay = 15 # time to wait for everything to load still under splash-screen
+    poll_interval = 0.5 # how often to look for the app while waiting for it
+    input_delay = 0.1 # delay between the events of one InputSequence
 
-    def __init__(self, command, appname=None, quit_shortcut='<Control><Q>', test=None):
+    def __init__(self, command, appname=None, quit_shortcut='<Control><Q>', test=None, policy=None, dialogs=None):
         """Inits the class instance with the information about a specific application
 
         @param command: a command to execute the app in terminal (without params! (use
@@ -57,6 +77,10 @@ class KdeApp(object):
         @param appname: a name of application as seen by a11y, only if different from command
         @param quit_shortcut:
         @param test: a name of the test to report to beaker, can be None
+        @param policy: a StepPolicy retrying the start/quit steps, default one if None,
+        False to disable
+        @param dialogs: a DialogWatcher handling dialogs popping up on start (e.g. with
+        kdePolkitRule), none are handled if None
         """
         if appname is None:
             appname = command
@@ -67,6 +91,16 @@ class KdeApp(object):
         self.test = test
         self.shortcut = quit_shortcut
         self.app = None
+        if policy is None:
+            policy = StepPolicy()
+        self.policy = policy or None
+        self.lastException = None
+        self.lastFailure = None
+        self.heldResults = None
+        if dialogs is None:
+            dialogs = DialogWatcher()
+        self.dialogWatcher = dialogs
+        self.triage = CrashTriage()
         self.updateCorePattern()
 
     def getHighestPid(self):
@@ -91,6 +125,7 @@ class KdeApp(object):
             printException()
             return False
 
+    @policyStep('start')
     def startViaMenu(self):
         """ Will run the app through the standard application launcher """
         try:
@@ -99,42 +134,52 @@ class KdeApp(object):
             click(self.corner_distance,height - self.corner_distance)
             plasma = root.application('plasma-desktop')
             plasma.child(name='Search:', roleName='label').click()
-            typeText(self.command)
-            sleep(1)
-            pressKey('enter')
-            sleep(5)
+            self.dialogWatcher.arm()
+            InputSequence(self.input_delay).typeText(self.command).wait(1).pressKey('enter').send()
+            self.waitForApp('start', 'startViaMenu', 5)
         except:
-            printException()
+            self.noteException()
             return False
+        finally:
+            self.dialogWatcher.disarm()
         self.__PID = self.getHighestPid()
         return self.checkRunning('Running %s via menu search' % self.appname)
 
+    @policyStep('start')
     def startViaKRunner(self):
         """ Simulates running app through Run command interface (alt-F2...)"""
         try:
             sleep(self.splashscreen_delay) #
             os.system('krunner')
             sleep(1.5)
-            typeText('%s' % self.command)
-            sleep(2)
-            pressKey('enter')
-            sleep(5)
+            self.dialogWatcher.arm()
+            InputSequence(self.input_delay).typeText('%s' % self.command).wait(2).pressKey('enter').send()
+            self.waitForApp('start', 'startViaKRunner', 5)
         except:
-            printException()
+            self.noteException()
             return False
+        finally:
+            self.dialogWatcher.disarm()
         self.__PID = self.getHighestPid()
         return self.checkRunning('Running %s via menu Run Command Interface' % self.appname)
 
+    @policyStep('start')
     def startViaCommand(self, params = '', timeout = 10):
         """ Directly executes the application, independent from the Desktop layout """
         try:
             if len(params) > 0:
                 params = " " + params
-            self.__PID = appRun(self.appname + params, timeout)
-            sleep(5)
+            # launched without any waiting, waitForApp does it all while it handles
+            # the dialogs which may block the start
+            self.dialogWatcher.arm()
+            launched = time.time()
+            self.__PID = Popen(shlex.split(self.appname + params)).pid
+            self.waitForApp('start', 'startViaCommand', timeout, launched=launched)
         except:
-            printException()
+            self.noteException()
             return False
+        finally:
+            self.dialogWatcher.disarm()
         return self.checkRunning('Running %s via command' % self.appname)
 
     def checkRunning(self, message, terminate = False):
@@ -153,31 +198,35 @@ class KdeApp(object):
         self.writeResult(message, result)
         return result
 
+    @policyStep('quit')
     def closeViaMenu(self, menu='File', menuitem='Quit'):
         """ Does execute 'Quit' item in the main menu """
         try:
             if not self.checkRunning('check %s is running before closing' % self.appname, False):
+                self.lastFailure = NOT_RUNNING
                 return False
             self.clickFocus()
             self.app.child(name=menu, roleName='menu item').click()
             sleep(1)
             self.app.child(name=menuitem, roleName='menu item').click()
-            sleep(2)
+            self.waitForApp('quit', 'closeViaMenu', 2, accessible=False)
         except:
-            printException()
+            self.noteException()
             return False
         return self.checkRunning('Quiting %s through menu' % self.appname, True)
 
+    @policyStep('quit')
     def closeViaShortcut(self):
         """ Exit the application through the predefined keyboard shortcut """
         try:
             if not self.checkRunning('check %s is running before closing' % self.appname, False):
+                self.lastFailure = NOT_RUNNING
                 return False
             self.clickFocus()
             keyCombo(self.shortcut)
-            sleep(2)
+            self.waitForApp('quit', 'closeViaShortcut', 2, accessible=False)
         except:
-            printException()
+            self.noteException()
             return False
         return self.checkRunning('Quiting %s through shortcut' % self.appname, True)
 
@@ -190,6 +239,10 @@ class KdeApp(object):
         @param result: Result of the test.
         @type result: Boolean
         """
+        if self.heldResults is not None:
+            # a retried step reports only its last attempt
+            self.heldResults.append((description, result))
+            return
         if result:
             result = "PASS"
             printOut("%s: %s" % (description, result))
@@ -203,20 +256,95 @@ class KdeApp(object):
                                                             result, log)
             Popen(cmd, shell = True).wait()
 
+    def appId(self):
+        return self.command
+
+    def readinessWindow(self, step, method, default):
+        """ How long to wait for the app to start or quit """
+        if self.policy is None:
+            return default
+        return self.policy.window(self.appId(), step, method, default)
+
+    def waitForApp(self, step, method, default, accessible=True, launched=None):
+        """ Wait until the app is accessible (or is gone) and remember how long
+            it took, give up after the readiness window. Without the time the
+            app was launched at, nothing is remembered if the app was already
+            in the awaited state """
+        window = self.readinessWindow(step, method, default)
+        start = time.time()
+        waited = launched is not None
+        while (self.findApp() is not None) != accessible:
+            waited = True
+            if time.time() - start > window:
+                return False
+            if self.dialogWatcher.poll() == 0:
+                sleep(self.poll_interval)
+        if waited and self.policy is not None:
+            if launched is not None:
+                start = launched
+            self.policy.recordLatency(self.appId(), method, time.time() - start)
+        return True
+
+    def noteException(self):
+        """ Print and remember the exception a step failed on """
+        self.lastException = sys.exc_info()[1]
+        printException()
+
+    def beginAttempt(self, step):
+        """ Hold back the results until it's clear the attempt is the last one """
+        self.lastException = None
+        self.lastFailure = None
+        self.heldResults = []
+
+    def classifyFailure(self, step):
+        """ Tell what kind of failure the last attempt of the step ended with """
+        if self.isCoreDump() is not False:
+            return CORE_DUMP
+        if self.lastFailure is not None:
+            return self.lastFailure
+        if isinstance(self.lastException, SearchError):
+            return SEARCH_MISS
+        if step == 'start' and self.getHighestPid() is None:
+            return PROCESS_CRASH
+        return ATSPI_TIMEOUT
+
+    def prepareRetry(self, step):
+        """ Get the app into a state the step can be repeated from """
+        if step == 'start':
+            if self.getHighestPid() is not None:
+                self.kill()
+                sleep(1)
+            return True
+        # checkRunning kills the app that refuses to quit
+        return self.getHighestPid() is not None
+
+    def endStep(self, step):
+        """ Report the results of the last attempt """
+        held = self.heldResults or []
+        self.heldResults = None
+        for description, result in held:
+            self.writeResult(description, result)
+
     def getPid(self):
         return os.system('pidof %s |wc -w' % self.command)
 
     def isAccessible(self):
         """ Returns true if the application is visible under the AT-SPI
             root desktop """
-        try:
-            self.app = root.child(name=self.appname, roleName='application', retry=False, recursive=False)
-            printOut("%s is accessible" % self.appname)
-            sleep(1)
-            return True
-        except SearchError:
+        self.app = self.findApp()
+        if self.app is None:
             printError("%s couldn't be found" % self.appname)
             return False
+        printOut("%s is accessible" % self.appname)
+        sleep(1)
+        return True
+
+    def findApp(self):
+        """ Returns the application node or None if it's not there """
+        try:
+            return root.child(name=self.appname, roleName='application', retry=False, recursive=False)
+        except SearchError:
+            return None
 
     def signal(self, signal):
         """ Sends a singal to the latest app process """
@@ -247,6 +375,10 @@ class KdeApp(object):
         Popen("chmod a+rwx /tmp/cores", shell = True).wait()
         Popen("echo \"/tmp/cores/core.%e.%s.%p\" | sudo tee /proc/sys/kernel/core_pattern", shell = True).wait()
 
+    def reportCrashes(self, timeout=60):
+        """ Wait for the triage of the caught core dumps and print its summaries """
+        return self.triage.report(timeout)
+
     def isCoreDump(self):
         """ Check if there is core dump created """
         dirPath = "/tmp/cores/"
@@ -254,5 +386,6 @@ class KdeApp(object):
         regexp = "core\.%s\.[0-9]{1,3}\.[0-9]*" % self.command
         for f in files:
             if re.match(regexp, f):
+                self.triage.submit(dirPath + f, self.command)
                 return int(f.split(".")[2])
         return False
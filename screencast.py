@@ -0,0 +1,149 @@
+#!/usr/bin/python
+"""
+Screencast recording of the tests through the GNOME Shell D-Bus API.
+
+The recorder knows whether it is recording, records with a low overhead
+preset by default and splits the recording into segments. When the test
+passes only the segments marked by keep() (e.g. failed attempts of a
+retried step) are left on the disk; when it fails, everything is kept.
+"""
+import os
+import time
+
+from gi.repository import Gio, GLib
+from dogtail.rawinput import keyCombo
+
+# framerate and resolution (None for the screen one) of the presets
+PRESETS = {
+    'full': (30, None),
+    'low': (10, None),
+    'minimal': (5, (960, 540)),
+}
+
+SCALED_PIPELINE = (
+    'videoscale ! video/x-raw,width=%d,height=%d ! '
+    'vp8enc min_quantizer=13 max_quantizer=13 cpu-used=5 deadline=1000000 threads=%%T ! '
+    'queue ! webmmux')
+
+
+class ScreencastRecorder(object):
+
+    """
+    Records the screen in segments, falls back to the Shell keybinding
+    if the D-Bus API is not available
+    """
+
+    def __init__(self, name, preset='low', directory=None, drawCursor=True):
+        """
+        name        prefix of the video files
+        preset      one of PRESETS
+        directory   where to store the videos, ~/Videos if None
+        drawCursor  should the cursor be recorded?
+        """
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), 'Videos')
+        self.name = name
+        self.directory = directory
+        (self.framerate, self.resolution) = PRESETS[preset]
+        self.drawCursor = drawCursor
+        self.recording = False
+        self.fallback = False
+        self.segments = []
+        self.kept = set()
+        try:
+            self.proxy = Gio.DBusProxy.new_for_bus_sync(
+                Gio.BusType.SESSION, Gio.DBusProxyFlags.NONE, None, 'org.gnome.Shell.Screencast',
+                '/org/gnome/Shell/Screencast', 'org.gnome.Shell.Screencast', None)
+        except GLib.Error:
+            self.proxy = None
+
+    def options(self):
+        options = {
+            'framerate': GLib.Variant('i', self.framerate),
+            'draw-cursor': GLib.Variant('b', self.drawCursor),
+        }
+        if self.resolution is not None:
+            options['pipeline'] = GLib.Variant('s', SCALED_PIPELINE % self.resolution)
+        return options
+
+    def start(self, label='test'):
+        """
+        Start recording a new segment
+        """
+        if self.recording:
+            return True
+        if not self.fallback and self.proxy is not None:
+            template = os.path.join(
+                self.directory, '%s-%s-%d' % (self.name, label, len(self.segments)))
+            try:
+                (success, filename) = self.proxy.call_sync(
+                    'Screencast', GLib.Variant('(sa{sv})', (template, self.options())),
+                    Gio.DBusCallFlags.NONE, -1, None).unpack()
+            except GLib.Error as error:
+                # the service is missing or refuses us, only then the keybinding is used
+                print("Warning: Screencast D-Bus API failed: %s" % error)
+                print("Warning: falling back to the screencast keybinding")
+                self.fallback = True
+            else:
+                if not success:
+                    # e.g. a recording is running already, toggling it would break it
+                    print("Warning: the screencast could not be started")
+                    return False
+                self.segments.append(filename)
+                self.recording = True
+                return True
+        keyCombo('<Control><Alt><Shift>R')
+        self.recording = True
+        return True
+
+    def stop(self):
+        if not self.recording:
+            return True
+        if self.fallback:
+            keyCombo('<Control><Alt><Shift>R')
+            self.recording = False
+            return True
+        try:
+            stopped = self.proxy.call_sync(
+                'StopScreencast', None, Gio.DBusCallFlags.NONE, -1, None).unpack()[0]
+        except GLib.Error as error:
+            print("Warning: Screencast D-Bus API failed: %s" % error)
+            return False
+        # the recording is still on when the Shell refuses to stop it
+        self.recording = not stopped
+        return stopped
+
+    def segment(self, label):
+        """
+        Finish the current segment and start a new one
+        """
+        if self.fallback or not self.recording:
+            return
+        if not self.stop():
+            print("Warning: the screencast could not be stopped, keeping the current segment")
+            return
+        self.start(label)
+
+    def keep(self):
+        """
+        Keep the current segment even if the test passes
+        """
+        if self.segments:
+            self.kept.add(self.segments[-1])
+
+    def finish(self, passed):
+        """
+        Stop recording and remove the segments not worth keeping
+        """
+        self.stop()
+        if not passed:
+            return
+        time.sleep(1)  # time for the last segment to be written
+        for filename in self.segments:
+            if filename in self.kept:
+                print("*** Keeping the video of a failed attempt: %s" % filename)
+                continue
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
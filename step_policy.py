@@ -0,0 +1,297 @@
+#!/usr/bin/python
+"""
+Retry and quarantine policy for the start/close steps of the app helpers.
+
+Every step (start or quit) of App or KdeApp is run through a StepPolicy.
+A failed attempt is classified, retried with a backoff if its kind is
+considered flaky, and the outcome is stored in per-app flake statistics
+on disk. Steps that keep being flaky are quarantined and get a bigger
+retry budget; steps that keep timing out get a longer readiness window.
+
+The readiness window itself is learned from the start and quit latencies
+observed in the previous runs of the app, see LatencyHistory.
+"""
+import os
+import json
+import time
+import fcntl
+import functools
+import math
+
+# failure kinds
+ATSPI_TIMEOUT = 'atspi-timeout'
+PROCESS_CRASH = 'process-crash'
+CORE_DUMP = 'core-dump'
+SEARCH_MISS = 'search-miss'
+NOT_RUNNING = 'not-running'  # there was nothing to close
+
+STATS_DIR = os.environ.get(
+    'DOGTAIL_GUI_HELPER_STATS',
+    os.path.join(os.path.expanduser('~'), '.cache', 'dogtail_gui_helper'))
+
+
+def loadJson(path):
+    """Load a json file, an empty dict is returned if it is missing or broken"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def makeDirs(directory):
+    """Create the directory unless it exists, another test may be creating it too"""
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            print("Warning: could not create '%s'" % directory)
+            return False
+    return True
+
+
+def saveJson(path, data):
+    """Atomically (over)write a json file"""
+    if not makeDirs(os.path.dirname(path)):
+        return False
+    tmpPath = '%s.%d' % (path, os.getpid())
+    try:
+        with open(tmpPath, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.rename(tmpPath, path)
+    except (IOError, OSError):
+        print("Warning: could not write '%s'" % path)
+        return False
+    return True
+
+
+def updateJson(path, update):
+    """
+    Re-read the json file, apply update(data) and write it back, all under
+    a lock as parallel tests share the file; returns the updated data
+    """
+    if not makeDirs(os.path.dirname(path)):
+        return None
+    try:
+        lock = open(path + '.lock', 'a')
+    except (IOError, OSError):
+        print("Warning: could not lock '%s'" % path)
+        return None
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        data = loadJson(path)
+        update(data)
+        saveJson(path, data)
+        return data
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+class FlakeStats(object):
+
+    """
+    Per-app and per-step flake statistics kept in a json file
+    """
+
+    maxWindowFactor = 4.0
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(STATS_DIR, 'flakes.json')
+        self.path = path
+        self.data = loadJson(path)
+
+    def entry(self, app, step, data=None):
+        if data is None:
+            data = self.data
+        return data.setdefault(app, {}).setdefault(step, {
+            'runs': 0, 'passes': 0, 'flaky': 0, 'failures': {}, 'windowFactor': 1.0})
+
+    def record(self, app, step, passed, failures):
+        """
+        Store the outcome of a step, failures is the list of failure
+        kinds of all its attempts
+        """
+        def update(data):
+            entry = self.entry(app, step, data)
+            entry['runs'] += 1
+            if passed:
+                entry['passes'] += 1
+                if failures:
+                    entry['flaky'] += 1
+            for kind in failures:
+                entry['failures'][kind] = entry['failures'].get(kind, 0) + 1
+            # the readiness window grows on every timeout and slowly shrinks back
+            if ATSPI_TIMEOUT in failures:
+                entry['windowFactor'] = min(entry['windowFactor'] * 1.5, self.maxWindowFactor)
+            elif passed:
+                entry['windowFactor'] = max(entry['windowFactor'] * 0.95, 1.0)
+
+        data = updateJson(self.path, update)
+        if data is None:
+            update(self.data)
+        else:
+            self.data = data
+
+    def flakeRate(self, app, step):
+        entry = self.entry(app, step)
+        if entry['runs'] == 0:
+            return 0.0
+        return float(entry['flaky']) / entry['runs']
+
+    def windowFactor(self, app, step):
+        return self.entry(app, step)['windowFactor']
+
+
+class LatencyHistory(object):
+
+    """
+    Observed start/quit latencies per app and per start/quit method
+    kept in a json file
+    """
+
+    def __init__(self, path=None, samples=50, minSamples=5, margin=1.25, padding=1.0, maxBudget=120.0):
+        """
+        samples     how many latest latencies are kept for each method
+        minSamples  how many latencies are needed before the default budget is replaced
+        margin      multiplier of the p99 latency
+        padding     seconds added to the p99 latency
+        maxBudget   the longest budget the history can come up with
+        """
+        if path is None:
+            path = os.path.join(STATS_DIR, 'latencies.json')
+        self.path = path
+        self.samples = samples
+        self.minSamples = minSamples
+        self.margin = margin
+        self.padding = padding
+        self.maxBudget = maxBudget
+        self.data = loadJson(path)
+
+    def record(self, app, method, latency):
+        def update(data):
+            latencies = data.setdefault(app, {}).setdefault(method, [])
+            latencies.append(round(latency, 3))
+            del latencies[:-self.samples]
+
+        data = updateJson(self.path, update)
+        if data is None:
+            update(self.data)
+        else:
+            self.data = data
+
+    def percentile(self, app, method, percent):
+        latencies = sorted(self.data.get(app, {}).get(method, []))
+        if not latencies:
+            return None
+        index = int(math.ceil(percent / 100.0 * len(latencies))) - 1
+        return latencies[max(index, 0)]
+
+    def budget(self, app, method, default):
+        """
+        How long to wait for the method of the app, p99 plus a margin,
+        the default until there are enough observations
+        """
+        if len(self.data.get(app, {}).get(method, [])) < self.minSamples:
+            return default
+        p99 = self.percentile(app, method, 99)
+        return min(p99 * self.margin + self.padding, self.maxBudget)
+
+
+class StepPolicy(object):
+
+    """
+    Runs the steps of a helper with retries and records their outcome
+    """
+
+    def __init__(
+        self, attempts=2, backoff=2.0, backoffFactor=2.0, retryOn=(ATSPI_TIMEOUT, SEARCH_MISS),
+            quarantineRate=0.2, quarantineRuns=5, quarantineAttempts=4, stats=None, latencies=None):
+        """
+        attempts            how many times is a step tried
+        backoff             seconds to wait before the first retry
+        backoffFactor       how much the wait grows with every next retry
+        retryOn             failure kinds worth a retry
+        quarantineRate      flake rate which puts the step into quarantine
+        quarantineRuns      how many runs are needed to decide about quarantine
+        quarantineAttempts  attempts of a quarantined step
+        stats               FlakeStats instance, the default file is used if None
+        latencies           LatencyHistory instance, the default file is used if None
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoffFactor = backoffFactor
+        self.retryOn = retryOn
+        self.quarantineRate = quarantineRate
+        self.quarantineRuns = quarantineRuns
+        self.quarantineAttempts = quarantineAttempts
+        if stats is None:
+            stats = FlakeStats()
+        self.stats = stats
+        if latencies is None:
+            latencies = LatencyHistory()
+        self.latencies = latencies
+
+    def isQuarantined(self, app, step):
+        entry = self.stats.entry(app, step)
+        return (entry['runs'] >= self.quarantineRuns and
+                self.stats.flakeRate(app, step) >= self.quarantineRate)
+
+    def window(self, app, step, method, default):
+        """
+        Readiness window of the step, learned from the latencies of the
+        method and stretched for apps known to time out
+        """
+        return self.latencies.budget(app, method, default) * self.stats.windowFactor(app, step)
+
+    def recordLatency(self, app, method, latency):
+        self.latencies.record(app, method, latency)
+
+    def run(self, helper, step, call):
+        """
+        Run the step until it passes or the attempts are exhausted.
+        The helper has to provide appId(), beginAttempt(step),
+        classifyFailure(step), prepareRetry(step) and endStep(step)
+        """
+        app = helper.appId()
+        budget = self.attempts
+        if self.isQuarantined(app, step):
+            budget = max(budget, self.quarantineAttempts)
+            print("*** The %s of '%s' is quarantined as flaky" % (step, app))
+
+        failures = []
+        result = False
+        try:
+            for attempt in range(1, budget + 1):
+                helper.beginAttempt(step)
+                result = call()
+                if result:
+                    break
+                kind = helper.classifyFailure(step)
+                failures.append(kind)
+                print("!!! Attempt %d/%d of the %s failed: %s" % (attempt, budget, step, kind))
+                if kind not in self.retryOn or attempt == budget:
+                    break
+                if not helper.prepareRetry(step):
+                    print("!!! The %s can't be retried" % step)
+                    break
+                time.sleep(self.backoff * self.backoffFactor ** (attempt - 1))
+        finally:
+            helper.endStep(step)
+            self.stats.record(app, step, bool(result), failures)
+        return result
+
+
+def policyStep(step):
+    """
+    Decorator running a helper method through the helper's StepPolicy
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.policy is None:
+                return method(self, *args, **kwargs)
+            return self.policy.run(self, step, lambda: method(self, *args, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,40 @@
+#!/usr/bin/python
+"""
+Lazy search of the accessibility tree.
+
+Node.findChildren() walks the whole subtree and builds the list of all the
+matches before returning. The generator here yields the matches as the
+walk reaches them, so a caller can stop after the first one(s) it needs
+(getMiniaturesPosition with a limit, DialogRule.find through findFirst),
+and it can skip the subtrees which can't contain what the caller wants.
+"""
+
+
+def iterChildren(node, pred, pruneRoles=(), showingOnly=False):
+    """
+    Yield the descendants of the node satisfying the predicate, in the same
+    (depth-first) order as findChildren does
+    pred        dogtail predicate or a callable taking a node
+    pruneRoles  roles whose subtrees are not searched (the node itself is)
+    showingOnly yield only the showing nodes and skip the subtrees of the hidden ones
+    """
+    if hasattr(pred, 'satisfiedByNode'):
+        pred = pred.satisfiedByNode
+    stack = list(reversed(node.children))
+    while stack:
+        child = stack.pop()
+        if showingOnly and not child.showing:
+            continue
+        if pred(child):
+            yield child
+        if child.roleName in pruneRoles:
+            continue
+        stack.extend(reversed(child.children))
+
+
+def findFirst(node, pred, **kwargs):
+    """
+    Return the first descendant satisfying the predicate or None
+    """
+    return next(iterChildren(node, pred, **kwargs), None)
+